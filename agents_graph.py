@@ -1,6 +1,11 @@
+import asyncio
+import json
+import threading
+from functools import lru_cache
 from typing import Annotated, Literal, TypedDict
 from typing_extensions import NotRequired
 from botocore.config import Config
+from cachetools import TTLCache
 from langchain.chat_models import init_chat_model
 from langchain_community.agent_toolkits import FileManagementToolkit
 from langchain_tavily import TavilySearch
@@ -9,11 +14,15 @@ from langchain_core.messages import (
     SystemMessage, 
     AIMessage, 
     ToolMessage, 
-    HumanMessage
+    HumanMessage,
+    message_chunk_to_message
 )
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, MessagesState, START, END
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.base import BaseStore
+from langgraph.store.memory import InMemoryStore
+from langgraph.config import get_stream_writer
 from langgraph.types import interrupt
 from langfuse import get_client, Langfuse
 from langfuse.langchain import CallbackHandler
@@ -21,13 +30,21 @@ from langfuse.langchain import CallbackHandler
 # Langfuse clientを取得
 langfuse = get_client()
 
-# 環境変数のロード
+# 環境変数のロード（同じプロセスで読み込み済みの場合はスキップ）
+import os
 from dotenv import load_dotenv
-load_dotenv()
+if not os.getenv("_DOTENV_LOADED"):
+    load_dotenv(override=False)
+    os.environ["_DOTENV_LOADED"] = "1"
 
-# デバッグログ出力
+# ログ出力（LOG_LEVEL=DEBUG でデバッグログを表示）
 import logging
-logging.basicConfig(level=logging.DEBUG)
+# 小文字や不明なレベル名はWARNINGとして扱う（basicConfigのValueErrorを防ぐ）
+log_level = os.getenv("LOG_LEVEL", "WARNING").upper()
+if not isinstance(logging.getLevelName(log_level), int):
+    log_level = "WARNING"
+logging.basicConfig(level=log_level)
+logger = logging.getLogger(__name__)
 
 
 # ========== ツールの定義 ==========
@@ -41,12 +58,47 @@ file_toolkit = FileManagementToolkit(
     selected_tools=["write_file"]  # 書き込みツールのみ有効化
 )
 write_file = file_toolkit.get_tools()[0]
-logging.debug("ファイルツールキット: %s", file_toolkit.get_tools()[0])
+logger.debug("ファイルツールキット: %s", file_toolkit.get_tools()[0])
 
 # 使用するツールのリスト
 tools = [web_search, write_file]
 tools_by_name = {tool.name: tool for tool in tools}
 
+# ========== ツール結果のキャッシュ ==========
+# 同じ引数のWeb検索は5分間キャッシュした結果を返す（セッション間で共有）
+_web_search_cache = TTLCache(maxsize=256, ttl=300)
+_web_search_cache_lock = threading.Lock()
+
+
+async def _invoke_web_search(tool_args: dict):
+    """Web検索を実行（同じ引数の結果はTTL付きでキャッシュ）"""
+    key = json.dumps(tool_args, sort_keys=True, ensure_ascii=False)
+    with _web_search_cache_lock:
+        cached = _web_search_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    result = await web_search.ainvoke(tool_args)
+    # TavilySearchは失敗時に例外ではなく{"error": ...}を返すため、成功時のみキャッシュ
+    if not (isinstance(result, dict) and "error" in result):
+        with _web_search_cache_lock:
+            _web_search_cache[key] = result
+    return result
+
+
+# ツール名 → 実行関数（キャッシュ対象のツールのみ）
+_TOOL_INVOKERS = {
+    web_search.name: _invoke_web_search,
+}
+
+
+def _invoke_tool(tool_call: dict):
+    """ツール呼び出しを実行するコルーチンを返す"""
+    invoker = _TOOL_INVOKERS.get(tool_call["name"])
+    if invoker:
+        return invoker(tool_call["args"])
+    return tools_by_name[tool_call["name"]].ainvoke(tool_call["args"])
+
 # ========== LLMの初期化 ==========
 cfg = Config(
     read_timeout=300,
@@ -55,6 +107,8 @@ llm_with_tools = init_chat_model(
     model="global.anthropic.claude-haiku-4-5-20251001-v1:0",
     model_provider="bedrock_converse",
     config=cfg,
+    # レイテンシ最適化推論（対応モデル・リージョンのみ。AWS_BEDROCK_LATENCY=optimized で有効化）
+    performance_config={"latency": os.getenv("AWS_BEDROCK_LATENCY", "standard")},
 ).bind_tools(tools)
 
 # システムプロンプト
@@ -67,6 +121,11 @@ system_prompt = """
   * Web検索が拒否された場合、Web検索を中止してレポート作成してください。
   * レポート保存を拒否された場合、レポート作成を中止し、内容をユーザーに直接伝えて下さい。
 """
+system_message = SystemMessage(content=system_prompt)
+
+# LangfuseのCallbackHandler（全ノード呼び出しで共有）
+# APIキーが未設定の場合はトレースしないため生成しない
+langfuse_handler = CallbackHandler() if os.getenv("LANGFUSE_PUBLIC_KEY") else None
 
 
 # ========== Graph ノードの定義 ==========
@@ -75,86 +134,166 @@ class AgentState(MessagesState):
     trace_id: NotRequired[str]
 
 
-def agent_node(state: AgentState) -> dict:
+@lru_cache(maxsize=32)
+def _get_run_config(trace_id: str | None) -> RunnableConfig:
+    """trace_idに対応するRunnableConfigを作成"""
+    config = RunnableConfig()
+    if langfuse_handler:
+        config["callbacks"] = [langfuse_handler]
+    if trace_id:
+        config["metadata"] = { 
+            "langfuse_session_id": trace_id,
+            "langfuse_tags": ["random-tag-1", "random-tag-2"]
+        }
+    return config
+
+
+async def agent_node(state: AgentState) -> dict:
     """LLMを呼び出してツール呼び出しを決定するノード"""
-    print(f"[Agent Node] メッセージ数: {len(state['messages'])}")
-    print(f"[Agent Node] trace_id: {state.get('trace_id')}")
+    logger.debug("[Agent Node] メッセージ数: %d", len(state["messages"]))
+    logger.debug("[Agent Node] trace_id: %s", state.get("trace_id"))
     
     # trace_idを取得（初回はNoneの可能性あり）
     trace_id = state.get("trace_id")
     
     # システムプロンプトを先頭に追加
-    messages = [SystemMessage(content=system_prompt)] + state["messages"]
+    messages = (system_message, *state["messages"])
     
-    # CallbackHandlerを初期化
-    langfuse_handler = CallbackHandler()
-    
-    # RunnableConfigを作成
-    config = RunnableConfig(callbacks=[langfuse_handler])
-    if trace_id:
-        config["metadata"] = { 
-            "langfuse_session_id": trace_id,
-            "langfuse_tags": ["random-tag-1", "random-tag-2"]
-        }
+    # RunnableConfigを取得（trace_idごとにキャッシュ）
+    config = _get_run_config(trace_id)
     
-    # LLM呼び出し
-    response = llm_with_tools.invoke(messages, config=config)
+    # LLM呼び出し（ストリーミングで受信したチャンクを1つのメッセージに結合）
+    # テキストはstream_mode="custom"で呼び出し元にトークン単位で通知する
+    writer = get_stream_writer()
+    response = None
+    async for chunk in llm_with_tools.astream(messages, config=config):
+        if chunk.text:
+            writer(chunk.text)
+        response = chunk if response is None else response + chunk
+    if response is None:
+        raise RuntimeError("LLMのストリームからチャンクを1件も受信できませんでした")
+    response = message_chunk_to_message(response)
     
-    print(f"[Agent Node] Tool calls: {len(response.tool_calls) if response.tool_calls else 0}")
+    logger.debug("[Agent Node] Tool calls: %d", len(response.tool_calls))
     
     # メッセージをstateに追加
     return {"messages": [response]}
 
 
-def human_approval_node(state: AgentState) -> dict:
+async def human_approval_node(state: AgentState, store: BaseStore) -> dict:
     """ツール実行前に人間の承認を求め、ツールを実行するノード"""
     last_message = state["messages"][-1]
     
-    print(f"[Human Approval Node] trace_id: {state.get('trace_id')}")
+    logger.debug("[Human Approval Node] trace_id: %s", state.get("trace_id"))
     
     if not isinstance(last_message, AIMessage) or not last_message.tool_calls:
         return {"messages": []}
     
-    tool_messages = _execute_tools_with_approval(last_message.tool_calls)
+    tool_messages = await _execute_tools_with_approval(last_message.tool_calls, store)
     
     # すべてのツール結果を返す
     return {"messages": tool_messages}
 
 
-def _execute_tools_with_approval(tool_calls):
+# 承認時に表示するツール情報のテンプレート
+_TOOL_NAME_TEMPLATE = "* ツール名\n  * {name}\n"
+_SEARCH_ARGS_TEMPLATE = _TOOL_NAME_TEMPLATE + "* 引数\n{args}"
+_ARG_TEMPLATE = "  * {key}\n    * {value}\n"
+_WRITE_FILE_ARGS_TEMPLATE = _TOOL_NAME_TEMPLATE + "* 保存ファイル名\n  * {file_path}"
+
+_WEB_SEARCH_NAME = web_search.name
+_WRITE_FILE_NAME = write_file.name
+
+# 承認画面で表示するHTMLの保存先（interruptの値やチェックポイントには参照キーのみ持たせる）
+TOOL_HTML_NAMESPACE = ("tool_html",)
+
+
+def _format_web_search(tool_call: dict, store: BaseStore) -> dict:
+    """Web検索ツールの承認時に表示するデータを作成"""
+    tool_args = tool_call["args"]
+    return {
+        "name": _WEB_SEARCH_NAME,
+        "args": _SEARCH_ARGS_TEMPLATE.format(
+            name=_WEB_SEARCH_NAME,
+            args="".join(
+                _ARG_TEMPLATE.format(key=key, value=value)
+                for key, value in tool_args.items()
+            )
+        )
+    }
+
+
+def _format_write_file(tool_call: dict, store: BaseStore) -> dict:
+    """ファイル書き込みツールの承認時に表示するデータを作成"""
+    tool_args = tool_call["args"]
+    # HTML本文はストアに保存し、tool_call_idを参照キーとして渡す
+    store.put(TOOL_HTML_NAMESPACE, tool_call["id"], {"html": tool_args["text"]})
+    return {
+        "name": _WRITE_FILE_NAME,
+        "args": _WRITE_FILE_ARGS_TEMPLATE.format(
+            name=_WRITE_FILE_NAME,
+            file_path=tool_args["file_path"]
+        ),
+        "html_ref": tool_call["id"]
+    }
+
+
+# ツール名 → 表示用データ作成関数
+_TOOL_DATA_FORMATTERS = {
+    _WEB_SEARCH_NAME: _format_web_search,
+    _WRITE_FILE_NAME: _format_write_file,
+}
+
+
+async def _execute_tools_with_approval(tool_calls, store: BaseStore):
     """ツールの承認と実行を行う内部関数"""
-    tool_messages = []
-    
     # 各ツール呼び出しに対して承認を求める
+    # 再開時はノードが先頭から再実行されるため、承認がすべて揃うまでツールは実行しない
+    feedbacks = []
     for tool_call in tool_calls:
         tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-        tool_data = {"name": tool_name}
         
         # ツールごとに表示用データを作成
-        if tool_name == web_search.name:
-            args = f'* ツール名\n'
-            args += f'  * {tool_name}\n'
-            args += "* 引数\n"
-            for key, value in tool_args.items():
-                args += f'  * {key}\n'
-                args += f'    * {value}\n'
-            tool_data["args"] = args
-        elif tool_name == write_file.name:
-            args = f'* ツール名\n'
-            args += f'  * {tool_name}\n'
-            args += f'* 保存ファイル名\n'
-            args += f'  * {tool_args["file_path"]}'
-            tool_data["args"] = args
-            tool_data["html"] = tool_args["text"]
+        formatter = _TOOL_DATA_FORMATTERS.get(tool_name)
+        tool_data = formatter(tool_call, store) if formatter else {"name": tool_name}
         
         # ユーザーに承認を求める（interrupt）
-        feedback = interrupt(tool_data)
-        
-        if feedback == "APPROVE":
-            # 承認されたツールを実行
-            tool = tools_by_name[tool_name]
-            observation = tool.invoke(tool_args)
+        feedbacks.append(interrupt(tool_data))
+    
+    # 承認がすべて揃ったら表示用に保存したHTMLは不要
+    for tool_call in tool_calls:
+        store.delete(TOOL_HTML_NAMESPACE, tool_call["id"])
+    
+    # 承認されたツールをまとめて並列実行
+    approved_calls = [
+        tool_call for tool_call, feedback in zip(tool_calls, feedbacks)
+        if feedback == "APPROVE"
+    ]
+    # 1つのツールが失敗しても他のツール結果は返せるよう、例外も結果として受け取る
+    observations = await asyncio.gather(*[
+        _invoke_tool(tool_call)
+        for tool_call in approved_calls
+    ], return_exceptions=True)
+    observations_by_id = {
+        tool_call["id"]: observation
+        for tool_call, observation in zip(approved_calls, observations)
+    }
+    
+    # tool_callsの順序でツール結果メッセージを作成
+    tool_messages = []
+    for tool_call in tool_calls:
+        observation = observations_by_id.get(tool_call["id"])
+        if isinstance(observation, Exception):
+            # 実行に失敗したツールはエラー内容をLLMに返す
+            tool_messages.append(
+                ToolMessage(
+                    content=f"ツールの実行中にエラーが発生しました: {observation}",
+                    name=tool_call["name"],
+                    tool_call_id=tool_call["id"],
+                    status="error"
+                )
+            )
+        elif tool_call["id"] in observations_by_id:
             tool_messages.append(
                 ToolMessage(
                     content=observation,
@@ -166,7 +305,7 @@ def _execute_tools_with_approval(tool_calls):
             tool_messages.append(
                 ToolMessage(
                     content="ツール利用が拒否されたため、処理を終了してください。",
-                    name=tool_name,
+                    name=tool_call["name"],
                     tool_call_id=tool_call["id"]
                 )
             )
@@ -207,7 +346,11 @@ workflow.add_conditional_edges(
 workflow.add_edge("human_approval", "agent")
 
 # チェックポインタの設定
+# 既定のJsonPlusSerializerがormsgpackでシリアライズするため、serdeは指定しない
 checkpointer = MemorySaver()
 
+# 承認画面用のHTMLなど、チェックポイントに含めない大きなデータの保存先
+store = InMemoryStore()
+
 # グラフのコンパイル
-agent_graph = workflow.compile(checkpointer=checkpointer)
+agent_graph = workflow.compile(checkpointer=checkpointer, store=store)
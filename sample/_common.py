@@ -0,0 +1,313 @@
+"""
+サンプルエージェント共通の定義
+- ツール
+- 構造化された出力（FinalAnswer）とそのスキーマ
+- グラフの状態・LLM・Human Reviewノード
+- コンソール用の入出力ヘルパー
+"""
+
+import ast
+import asyncio
+import math
+import operator
+import os
+from functools import lru_cache
+from typing import Annotated, Sequence, TypedDict, Literal
+from pydantic import BaseModel, Field
+
+import boto3
+from botocore.config import Config
+
+from langchain_core.messages import BaseMessage, ToolMessage
+from langchain_core.tools import tool
+from langchain_aws import ChatBedrock
+
+from langgraph.types import interrupt
+
+
+# ========== ツールの定義 ==========
+
+@lru_cache(maxsize=256)
+def _search_web(query: str) -> str:
+    """Web検索の実処理（同じクエリの結果はキャッシュ）"""
+    # 実際のWeb検索APIを使用する場合はここを実装
+    return f"'{query}'についての検索結果: これはサンプルの検索結果です。"
+
+
+@tool
+def search_web(query: str) -> str:
+    """Webで情報を検索します。"""
+    return _search_web(query)
+
+
+# べき乗の結果として許可する整数の最大ビット数（9**9**9のような計算でCPUを占有させない）
+_MAX_POWER_BITS = 4096
+
+
+def _safe_pow(base: float, exponent: float) -> float:
+    """結果が大きくなりすぎるべき乗を拒否してから計算"""
+    if (
+        isinstance(base, int) and isinstance(exponent, int)
+        and abs(base) > 1
+        and abs(base).bit_length() * abs(exponent) > _MAX_POWER_BITS
+    ):
+        raise ValueError("べき乗の結果が大きすぎます")
+    return operator.pow(base, exponent)
+
+
+# calculatorで使用できる演算子と定数
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: _safe_pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+_ALLOWED_NAMES = {
+    "pi": math.pi,
+    "e": math.e,
+}
+
+
+def _evaluate_node(node: ast.AST) -> float:
+    """数式のASTを許可された演算だけで評価"""
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        return _BINARY_OPERATORS[type(node.op)](
+            _evaluate_node(node.left), _evaluate_node(node.right)
+        )
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate_node(node.operand))
+    if isinstance(node, ast.Name) and node.id in _ALLOWED_NAMES:
+        return _ALLOWED_NAMES[node.id]
+    raise ValueError(f"使用できない式です: {ast.unparse(node)}")
+
+
+@lru_cache(maxsize=1024)
+def _evaluate_expression(expression: str) -> float:
+    """数式を構文解析して評価（同じ式の結果はキャッシュ）"""
+    return _evaluate_node(ast.parse(expression, mode="eval").body)
+
+
+@tool
+def calculator(expression: str) -> str:
+    """数式を計算します。例: '2 + 2' や '10 * 5'"""
+    try:
+        # evalは使わず、四則演算などに限定して評価する
+        result = _evaluate_expression(expression)
+        return f"計算結果: {result}"
+    except Exception as e:
+        return f"エラー: {str(e)}"
+
+
+@lru_cache(maxsize=256)
+def _get_current_info(topic: str) -> str:
+    """現在の情報取得の実処理（同じトピックの結果はキャッシュ）"""
+    return f"'{topic}'についての現在の情報: これはサンプル情報です。"
+
+
+@tool
+def get_current_info(topic: str) -> str:
+    """特定のトピックについての現在の情報を取得します。"""
+    return _get_current_info(topic)
+
+
+# ツールのリスト
+tools = [search_web, calculator, get_current_info]
+
+
+# ========== 構造化された出力の定義 ==========
+
+class FinalAnswer(BaseModel):
+    """エージェントの最終的な構造化された回答"""
+    summary: str = Field(description="タスクの要約")
+    findings: list[str] = Field(description="発見した重要な情報のリスト")
+    calculations: dict[str, float] = Field(
+        default_factory=dict,
+        description="実行した計算とその結果"
+    )
+    confidence: float = Field(
+        ge=0.0, le=1.0,
+        description="回答の信頼度（0.0-1.0）"
+    )
+    sources: list[str] = Field(
+        default_factory=list,
+        description="使用した情報源"
+    )
+
+
+# JSONスキーマとバリデータはimport時に一度だけ生成して使い回す
+FINAL_ANSWER_SCHEMA = FinalAnswer.model_json_schema()
+FINAL_ANSWER_VALIDATOR = FinalAnswer.__pydantic_validator__
+
+# FinalAnswerを出力させるツール定義
+FINAL_ANSWER_TOOL = {
+    "name": FinalAnswer.__name__,
+    "description": FinalAnswer.__doc__,
+    "input_schema": FINAL_ANSWER_SCHEMA,
+}
+
+
+# ========== グラフの状態定義 ==========
+
+class AgentState(TypedDict):
+    """エージェントの状態"""
+    # reducerは新しいリストを返すこと（a.extend(b)のようなin-place更新は不可）
+    # 条件分岐の評価時にはチャネルの浅いコピーへ書き込みが適用されるため、
+    # 元のリストを書き換えるとメッセージが重複して追加される
+    messages: Annotated[Sequence[BaseMessage], operator.add]
+    final_answer: FinalAnswer | None
+
+
+# ========== LLMの初期化 ==========
+# load_dotenv()は__main__で呼ばれるため、モデルIDや認証情報はノード実行時に解決し
+# boto3クライアントとChatBedrockはキャッシュして各ステップで使い回す
+
+DEFAULT_MODEL_ID = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+
+
+def get_model_id() -> str:
+    """使用するBedrockのモデルIDを取得"""
+    return os.getenv("AWS_BEDROCK_MODEL", DEFAULT_MODEL_ID)
+
+
+@lru_cache(maxsize=1)
+def get_bedrock_client():
+    """bedrock-runtimeクライアントを一度だけ生成し、全てのChatBedrockで共有"""
+    session = boto3.Session()
+    return session.client(
+        "bedrock-runtime",
+        config=Config(read_timeout=300, max_pool_connections=32)
+    )
+
+
+@lru_cache(maxsize=8)
+def get_llm(model_id: str, temperature: float = 0) -> ChatBedrock:
+    """ChatBedrockを (model_id, temperature) ごとに一度だけ生成して再利用"""
+    return ChatBedrock(
+        client=get_bedrock_client(),
+        model_id=model_id,
+        model_kwargs={"temperature": temperature}
+    )
+
+
+@lru_cache(maxsize=8)
+def get_final_answer_llm(model_id: str, temperature: float = 0):
+    """FinalAnswerツールの呼び出しを強制したLLMを返す（bind_toolsは一度だけ実行）"""
+    return get_llm(model_id, temperature).bind_tools(
+        [FINAL_ANSWER_TOOL],
+        tool_choice=FINAL_ANSWER_TOOL["name"]
+    )
+
+
+# ========== ノードの定義 ==========
+
+def human_review_node(state: AgentState) -> dict:
+    """
+    人間のレビューを待つノード（interrupt使用）
+    
+    このノードはinterrupt()を呼び出してグラフを一時停止します。
+    外部から承認/拒否の応答を受け取るまで待機します。
+    """
+    messages = state["messages"]
+    last_message = messages[-1]
+    
+    # ツール情報を取得
+    tool_calls_info = [
+        {
+            "name": tool_call["name"],
+            "args": tool_call["args"],
+            "id": tool_call["id"]
+        }
+        for tool_call in getattr(last_message, "tool_calls", None) or []
+    ]
+    
+    # interrupt()を呼び出してグラフを一時停止
+    # 戻り値として承認データを期待
+    approval_data = interrupt({
+        "type": "human_review",
+        "tool_calls": tool_calls_info,
+        "message": "ツールの実行には承認が必要です"
+    })
+    
+    # approval_dataの形式:
+    # {"approved": True} または {"approved": False, "feedback": "..."}
+    
+    if approval_data.get("approved"):
+        # 承認された場合、何も返さない（toolsノードへ進む）
+        return {}
+    else:
+        # 拒否された場合、すべてのツール呼び出しにフィードバックを返す
+        # （結果のないtool_use idが残るとBedrockの検証エラーになる）
+        feedback = approval_data.get("feedback", "ユーザーが拒否しました")
+        return {
+            "messages": [
+                ToolMessage(
+                    content=f"ユーザーがキャンセルしました。フィードバック: {feedback}",
+                    name=tool_call["name"],
+                    tool_call_id=tool_call["id"]
+                )
+                for tool_call in tool_calls_info
+            ]
+        }
+
+
+def after_human_review(state: AgentState) -> Literal["tools", "agent"]:
+    """human_reviewの後はtoolsへ（承認時）またはagentへ（拒否時）"""
+    messages = state["messages"]
+    if messages:
+        last_msg = messages[-1]
+        # ToolMessageがある = 拒否された
+        if isinstance(last_msg, ToolMessage):
+            return "agent"
+    # それ以外は承認 = toolsへ
+    return "tools"
+
+
+# ========== コンソール入出力 ==========
+
+async def ask_human_review(interrupt_value: dict) -> dict:
+    """ツール情報を表示してユーザーに承認/拒否を確認し、interruptへの応答を返す"""
+    print("\n" + "="*50)
+    print("🔍 Human Review Required")
+    print("="*50)
+    
+    # ツール情報を表示
+    for tool_call in interrupt_value.get("tool_calls", []):
+        print(f"\nツール: {tool_call['name']}")
+        print(f"引数: {tool_call['args']}")
+    
+    print("\n承認しますか？")
+    print("  y/yes: 承認して続行")
+    print("  n/no: 拒否してフィードバックを入力")
+    
+    user_input = (await asyncio.to_thread(input, "\n入力 > ")).strip().lower()
+    
+    if user_input in ["y", "yes"]:
+        # 承認
+        return {"approved": True}
+    
+    # 拒否してフィードバック
+    feedback = await asyncio.to_thread(input, "フィードバックを入力してください > ")
+    return {"approved": False, "feedback": feedback}
+
+
+def print_final_answer(final_answer: FinalAnswer) -> None:
+    """最終的な構造化された出力を表示"""
+    print("\n" + "="*50)
+    print("✅ 最終的な構造化された出力")
+    print("="*50)
+    print(f"\n要約: {final_answer.summary}")
+    print(f"\n発見事項:")
+    for i, finding in enumerate(final_answer.findings, 1):
+        print(f"  {i}. {finding}")
+    print(f"\n計算結果: {final_answer.calculations}")
+    print(f"信頼度: {final_answer.confidence}")
+    print(f"情報源: {final_answer.sources}")
@@ -5,46 +5,37 @@ LangGraphを使用したエージェント実装（interrupt版）
 - 構造化された出力
 """
 
-import operator
+import asyncio
+import logging
 import os
-from typing import Annotated, Sequence, TypedDict, Literal
-from pydantic import BaseModel, Field
+from functools import lru_cache
+from typing import Literal
 
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage, message_chunk_to_message
 from langchain_core.tools import tool
-from langchain_aws import ChatBedrock
 
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.types import interrupt
+from langgraph.types import Command
 
+from _common import (
+    FINAL_ANSWER_VALIDATOR,
+    AgentState,
+    after_human_review,
+    ask_human_review,
+    get_llm,
+    get_model_id,
+    human_review_node,
+    print_final_answer,
+    tools as common_tools,
+)
 
-# ========== ツールの定義 ==========
-
-@tool
-def search_web(query: str) -> str:
-    """Webで情報を検索します。"""
-    # 実際のWeb検索APIを使用する場合はここを実装
-    return f"'{query}'についての検索結果: これはサンプルの検索結果です。"
 
-
-@tool
-def calculator(expression: str) -> str:
-    """数式を計算します。例: '2 + 2' や '10 * 5'"""
-    try:
-        # 安全性のため、evalの代わりに制限された計算を行う
-        result = eval(expression, {"__builtins__": {}}, {})
-        return f"計算結果: {result}"
-    except Exception as e:
-        return f"エラー: {str(e)}"
+logger = logging.getLogger(__name__)
 
 
-@tool
-def get_current_info(topic: str) -> str:
-    """特定のトピックについての現在の情報を取得します。"""
-    return f"'{topic}'についての現在の情報: これはサンプル情報です。"
-
+# ========== ツールの定義 ==========
 
 @tool
 def submit_final_answer(
@@ -67,53 +58,38 @@ def submit_final_answer(
     return "最終回答を受け付けました。"
 
 
-# ツールのリスト
-tools = [search_web, calculator, get_current_info, submit_final_answer]
-
+# ツールのリスト（共通ツール + 最終回答の提出）
+tools = [*common_tools, submit_final_answer]
 
-# ========== 構造化された出力の定義 ==========
 
-class FinalAnswer(BaseModel):
-    """エージェントの最終的な構造化された回答"""
-    summary: str = Field(description="タスクの要約")
-    findings: list[str] = Field(description="発見した重要な情報のリスト")
-    calculations: dict[str, float] = Field(
-        default_factory=dict,
-        description="実行した計算とその結果"
-    )
-    confidence: float = Field(
-        ge=0.0, le=1.0,
-        description="回答の信頼度（0.0-1.0）"
-    )
-    sources: list[str] = Field(
-        default_factory=list,
-        description="使用した情報源"
-    )
-
-
-# ========== グラフの状態定義 ==========
+# ========== LLMの初期化 ==========
 
-class AgentState(TypedDict):
-    """エージェントの状態"""
-    messages: Annotated[Sequence[BaseMessage], operator.add]
-    final_answer: FinalAnswer | None
+@lru_cache(maxsize=8)
+def get_llm_with_tools(model_id: str, temperature: float = 0):
+    """ツールをバインド済みのLLMを返す（bind_toolsは一度だけ実行）"""
+    return get_llm(model_id, temperature).bind_tools(tools)
 
 
 # ========== ノードの定義 ==========
 
-def agent_node(state: AgentState) -> dict:
-    """エージェントノード: LLMを呼び出してアクションを決定"""
-    llm = ChatBedrock(
-        model_id=os.getenv("AWS_BEDROCK_MODEL", "anthropic.claude-3-5-sonnet-20241022-v2:0"),
-        model_kwargs={"temperature": 0}
-    )
-    
-    messages = state["messages"]
-    
-    # システムプロンプトを追加（最初のメッセージがSystemMessageでない場合）
-    if not messages or not isinstance(messages[0], BaseMessage) or messages[0].type != "system":
-        system_prompt = HumanMessage(
-            content="""あなたは有能なAIアシスタントです。利用可能なツールを使ってユーザーのタスクを完了してください。
+def _format_message(index: int, msg: BaseMessage) -> str:
+    """ログ出力用にメッセージ1件を整形"""
+    lines = [f"[メッセージ {index}] {type(msg).__name__}"]
+    text = msg.text
+    if text:
+        content = text[:150] + "..." if len(text) > 150 else text
+        lines.append(f"Content: {content}")
+    tool_calls = getattr(msg, "tool_calls", None)
+    if tool_calls:
+        lines.append(f"Tool Calls: {tool_calls}")
+    if isinstance(msg, ToolMessage):
+        lines.append(f"Tool Call ID: {msg.tool_call_id}")
+    return "\n".join(lines)
+
+
+# システムプロンプト（import時に一度だけ生成して使い回す）
+system_message = HumanMessage(
+    content="""あなたは有能なAIアシスタントです。利用可能なツールを使ってユーザーのタスクを完了してください。
 
 重要な指示：
 1. 必要に応じてツール（search_web, calculator, get_current_info）を使用してください
@@ -128,73 +104,58 @@ def agent_node(state: AgentState) -> dict:
 例：
 - ユーザーが計算を依頼 → calculator ツール使用 → submit_final_answer で結果を報告
 - ユーザーが情報検索を依頼 → search_web ツール使用 → submit_final_answer で結果を報告"""
-        )
-        messages = [system_prompt] + list(messages)
+)
+
+
+async def agent_node(state: AgentState) -> dict:
+    """エージェントノード: LLMを呼び出してアクションを決定"""
+    llm_with_tools = get_llm_with_tools(get_model_id())
     
-    # 入力プロンプトをログ出力
-    print("\n" + "="*50)
-    print("🤖 Agent Node - 入力プロンプト")
-    print("="*50)
-    for i, msg in enumerate(messages, 1):
-        msg_type = type(msg).__name__
-        print(f"\n[メッセージ {i}] {msg_type}")
-        if hasattr(msg, "content") and msg.content:
-            content_preview = msg.content[:150] + "..." if len(msg.content) > 150 else msg.content
-            print(f"Content: {content_preview}")
-        if hasattr(msg, "tool_calls") and msg.tool_calls:
-            print(f"Tool Calls: {msg.tool_calls}")
-        if isinstance(msg, ToolMessage):
-            print(f"Tool Call ID: {msg.tool_call_id}")
+    messages = state["messages"]
     
-    # LLMにツール呼び出しを判断させる
-    llm_with_tools = llm.bind_tools(tools)
-    response = llm_with_tools.invoke(messages)
+    # システムプロンプトを追加（最初のメッセージがSystemMessageでない場合）
+    if not messages or not isinstance(messages[0], BaseMessage) or messages[0].type != "system":
+        messages = (system_message, *messages)
+    
+    # 入力プロンプトをログ出力（前回までのメッセージは出力済みのため、最新の1件のみ）
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "🤖 Agent Node - 入力プロンプト（%d件）\n%s",
+            len(messages), _format_message(len(messages), messages[-1])
+        )
+    
+    # LLMにツール呼び出しを判断させる（ストリーミングで受信したチャンクを1つのメッセージに結合）
+    response = None
+    async for chunk in llm_with_tools.astream(messages):
+        response = chunk if response is None else response + chunk
+    if response is None:
+        raise RuntimeError("LLMのストリームからチャンクを1件も受信できませんでした")
+    response = message_chunk_to_message(response)
     
     # 出力プロンプトをログ出力
-    print("\n" + "="*50)
-    print("🤖 Agent Node - 出力プロンプト")
-    print("="*50)
-    print(f"Response Type: {type(response).__name__}")
-    if hasattr(response, "content") and response.content:
-        print(f"Content: {response.content}")
-    if hasattr(response, "tool_calls") and response.tool_calls:
-        print(f"\nTool Calls ({len(response.tool_calls)}件):")
-        for tc in response.tool_calls:
-            print(f"  - ツール: {tc['name']}")
-            print(f"    引数: {tc['args']}")
-            print(f"    ID: {tc['id']}")
-            
-            # submit_final_answerが呼ばれた場合、構造化出力を生成
-            if tc['name'] == 'submit_final_answer':
-                print("\n🎯 submit_final_answer検出 → 構造化出力を生成します")
-                args = tc['args']
-                final_answer = FinalAnswer(
-                    summary=args.get('summary', ''),
-                    findings=args.get('findings', []),
-                    calculations=args.get('calculations', {}),
-                    confidence=args.get('confidence', 1.0),
-                    sources=args.get('sources', [])
-                )
-                
-                print("\n" + "="*50)
-                print("🤖 Agent Node - 構造化出力")
-                print("="*50)
-                print(f"型: {type(final_answer).__name__}")
-                print(f"\n要約: {final_answer.summary}")
-                print(f"\n発見事項 ({len(final_answer.findings)}件):")
-                for i, finding in enumerate(final_answer.findings, 1):
-                    print(f"  {i}. {finding}")
-                print(f"\n計算結果: {final_answer.calculations}")
-                print(f"信頼度: {final_answer.confidence}")
-                print(f"情報源: {final_answer.sources}")
-                print("="*50 + "\n")
-                
-                return {
-                    "messages": [response],
-                    "final_answer": final_answer
-                }
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "🤖 Agent Node - 出力プロンプト\n%s",
+            _format_message(len(messages) + 1, response)
+        )
     
-    print("="*50 + "\n")
+    # submit_final_answerが呼ばれた場合、構造化出力を生成
+    for tc in response.tool_calls:
+        if tc['name'] == 'submit_final_answer':
+            args = tc['args']
+            final_answer = FINAL_ANSWER_VALIDATOR.validate_python({
+                "summary": args.get('summary', ''),
+                "findings": args.get('findings', []),
+                "calculations": args.get('calculations', {}),
+                "confidence": args.get('confidence', 1.0),
+                "sources": args.get('sources', [])
+            })
+            logger.debug("🎯 submit_final_answer検出 → 構造化出力: %r", final_answer)
+            
+            return {
+                "messages": [response],
+                "final_answer": final_answer
+            }
     
     return {"messages": [response]}
 
@@ -208,128 +169,20 @@ def should_continue(state: AgentState) -> Literal["tools", "human_review", "end"
     messages = state["messages"]
     last_message = messages[-1]
     
-    # ツール呼び出しがある場合
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        tool_names = [tc["name"] for tc in last_message.tool_calls]
-        
-        # submit_final_answerが呼ばれた場合は終了（構造化出力済み）
-        if "submit_final_answer" in tool_names:
-            return "end"
-        
-        # 重要な操作（例: calculator）の場合は人間のレビューを要求
-        if "calculator" in tool_names:
-            return "human_review"
-        
-        return "tools"
-    
     # ツール呼び出しがない場合は終了
-    return "end"
-
-
-def human_review_node(state: AgentState) -> dict:
-    """
-    人間のレビューを待つノード（interrupt使用）
-    
-    このノードはinterrupt()を呼び出してグラフを一時停止します。
-    外部から承認/拒否の応答を受け取るまで待機します。
-    """
-    messages = state["messages"]
-    last_message = messages[-1]
-    
-    # ツール情報を取得
-    tool_calls_info = []
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        for tool_call in last_message.tool_calls:
-            tool_calls_info.append({
-                "name": tool_call["name"],
-                "args": tool_call["args"],
-                "id": tool_call["id"]
-            })
-    
-    # interrupt()を呼び出してグラフを一時停止
-    # 戻り値として承認データを期待
-    approval_data = interrupt({
-        "type": "human_review",
-        "tool_calls": tool_calls_info,
-        "message": "ツールの実行には承認が必要です"
-    })
-    
-    # approval_dataの形式:
-    # {"approved": True} または {"approved": False, "feedback": "..."}
-    
-    if approval_data.get("approved"):
-        # 承認された場合、何も返さない（次のノードへ進む）
-        return {}
-    else:
-        # 拒否された場合、フィードバックを追加
-        feedback = approval_data.get("feedback", "ユーザーが拒否しました")
-        return {
-            "messages": [
-                ToolMessage(
-                    content=f"ユーザーがキャンセルしました。フィードバック: {feedback}",
-                    tool_call_id=tool_calls_info[0]["id"]
-                )
-            ]
-        }
-
-
-# def finalize_node(state: AgentState) -> dict:
-#     """最終的な構造化された出力を生成"""
-#     llm = ChatBedrock(
-#         model_id=os.getenv("AWS_BEDROCK_MODEL", "anthropic.claude-3-5-sonnet-20241022-v2:0"),
-#         model_kwargs={"temperature": 0}
-#     )
-    
-#     # Pydanticモデルで構造化された出力を生成
-#     structured_llm = llm.with_structured_output(FinalAnswer)
-    
-#     # 会話履歴から最終回答を生成
-#     messages = state["messages"]
-#     final_prompt = HumanMessage(
-#         content="これまでの会話内容を基に、構造化された最終回答を生成してください。"
-#     )
-    
-#     # 入力プロンプトをログ出力
-#     print("\n" + "="*50)
-#     print("📝 Finalize Node - 入力プロンプト")
-#     print("="*50)
-#     print(f"メッセージ履歴: {len(messages)}件")
-#     for i, msg in enumerate(messages, 1):
-#         msg_type = type(msg).__name__
-#         print(f"\n[メッセージ {i}] {msg_type}")
-#         if hasattr(msg, "content") and msg.content:
-#             content_preview = msg.content[:100] + "..." if len(msg.content) > 100 else msg.content
-#             print(f"Content: {content_preview}")
-#         if hasattr(msg, "tool_calls") and msg.tool_calls:
-#             print(f"Tool Calls: {len(msg.tool_calls)}件")
-#         if isinstance(msg, ToolMessage):
-#             print(f"Tool Call ID: {msg.tool_call_id}")
-    
-#     print(f"\n[追加プロンプト] {type(final_prompt).__name__}")
-#     print(f"Content: {final_prompt.content}")
-#     print("="*50)
+    tool_calls = getattr(last_message, "tool_calls", None)
+    if not tool_calls:
+        return "end"
     
-#     # LLMを呼び出し
-#     final_answer = structured_llm.invoke(list(messages) + [final_prompt])
+    # submit_final_answerが呼ばれた場合は終了（構造化出力済み）
+    if any(tc["name"] == "submit_final_answer" for tc in tool_calls):
+        return "end"
     
-#     # 出力プロンプト（構造化された結果）をログ出力
-#     print("\n" + "="*50)
-#     print("📝 Finalize Node - 出力プロンプト（構造化された結果）")
-#     print("="*50)
-#     print(f"型: {type(final_answer).__name__}")
-#     print(f"\n要約: {final_answer.summary}")
-#     print(f"\n発見事項 ({len(final_answer.findings)}件):")
-#     for i, finding in enumerate(final_answer.findings, 1):
-#         print(f"  {i}. {finding}")
-#     print(f"\n計算結果: {final_answer.calculations}")
-#     print(f"信頼度: {final_answer.confidence}")
-#     print(f"情報源: {final_answer.sources}")
-#     print("="*50 + "\n")
+    # 重要な操作（例: calculator）の場合は人間のレビューを要求
+    if any(tc["name"] == "calculator" for tc in tool_calls):
+        return "human_review"
     
-#     return {
-#         "final_answer": final_answer,
-#         "messages": [AIMessage(content="最終回答を生成しました。")]
-#     }
+    return "tools"
 
 
 # ========== グラフの構築 ==========
@@ -346,7 +199,7 @@ def create_agent_graph():
     workflow.add_node("agent", agent_node)
     workflow.add_node("tools", tool_node)
     workflow.add_node("human_review", human_review_node)
-    # finalize_nodeは削除（agent_nodeで直接構造化出力）
+    # finalizeノードは使わない（agent_nodeで直接構造化出力）
     
     # エントリーポイントを設定
     workflow.set_entry_point("agent")
@@ -363,17 +216,6 @@ def create_agent_graph():
     )
     
     # human_reviewの後はtoolsへ（承認時）またはagentへ（拒否時）
-    # human_review_nodeの返り値で判断
-    def after_human_review(state: AgentState) -> Literal["tools", "agent"]:
-        messages = state["messages"]
-        if messages:
-            last_msg = messages[-1]
-            # ToolMessageがある = 拒否された
-            if isinstance(last_msg, ToolMessage):
-                return "agent"
-        # それ以外は承認 = toolsへ
-        return "tools"
-    
     workflow.add_conditional_edges(
         "human_review",
         after_human_review,
@@ -394,7 +236,7 @@ def create_agent_graph():
 
 # ========== メイン実行 ==========
 
-def main():
+async def main():
     """メイン実行関数（interrupt対応）"""
     print("LangGraph エージェント with Human-in-the-Loop (Interrupt版)")
     print("="*50)
@@ -403,7 +245,7 @@ def main():
     app = create_agent_graph()
     
     # 初期メッセージ
-    initial_message = input("\nタスクを入力してください > ")
+    initial_message = await asyncio.to_thread(input, "\nタスクを入力してください > ")
     
     # 設定
     config = {"configurable": {"thread_id": "1"}}
@@ -421,33 +263,28 @@ def main():
     
     while True:
         # グラフを実行
-        for event in app.stream(current_state, config, stream_mode="values"):
+        # durability="sync": チェックポイントを各ステップで同期保存し、
+        # 非同期保存待ちのチェックポイントがメモリに溜まらないようにする
+        async for event in app.astream(current_state, config, stream_mode="values", durability="sync"):
             # デバッグ出力
             if "messages" in event and event["messages"]:
                 last_msg = event["messages"][-1]
                 msg_type = type(last_msg).__name__
-                if hasattr(last_msg, "content") and last_msg.content:
-                    print(f"💬 {msg_type}: {last_msg.content[:100]}...")
-                elif hasattr(last_msg, "tool_calls") and last_msg.tool_calls:
-                    print(f"🔧 {msg_type}: ツール呼び出し {len(last_msg.tool_calls)}件")
+                # ストリーミングで結合したメッセージのcontentはブロックのリストの場合があるため、テキストのみ取り出す
+                content = last_msg.text
+                tool_calls = getattr(last_msg, "tool_calls", None)
+                if content:
+                    print(f"💬 {msg_type}: {content[:100]}...")
+                elif tool_calls:
+                    print(f"🔧 {msg_type}: ツール呼び出し {len(tool_calls)}件")
             
             # 最終結果をチェック
             if event.get("final_answer"):
-                print("\n" + "="*50)
-                print("✅ 最終的な構造化された出力")
-                print("="*50)
-                final_answer = event["final_answer"]
-                print(f"\n要約: {final_answer.summary}")
-                print(f"\n発見事項:")
-                for i, finding in enumerate(final_answer.findings, 1):
-                    print(f"  {i}. {finding}")
-                print(f"\n計算結果: {final_answer.calculations}")
-                print(f"信頼度: {final_answer.confidence}")
-                print(f"情報源: {final_answer.sources}")
+                print_final_answer(event["final_answer"])
                 return
         
         # interruptが発生したかチェック
-        snapshot = app.get_state(config)
+        snapshot = await app.aget_state(config)
         
         if not snapshot.next:
             # 次のノードがない = 完了
@@ -458,40 +295,11 @@ def main():
             task = snapshot.tasks[0]
             if task.interrupts:
                 interrupt_value = task.interrupts[0].value
+                approval_data = await ask_human_review(interrupt_value)
                 
-                print("\n" + "="*50)
-                print("🔍 Human Review Required")
-                print("="*50)
-                
-                # ツール情報を表示
-                for tool_call in interrupt_value.get("tool_calls", []):
-                    print(f"\nツール: {tool_call['name']}")
-                    print(f"引数: {tool_call['args']}")
-                
-                print("\n承認しますか？")
-                print("  y/yes: 承認して続行")
-                print("  n/no: 拒否してフィードバックを入力")
-                
-                user_input = input("\n入力 > ").strip().lower()
-                
-                if user_input in ["y", "yes"]:
-                    # 承認して再開
-                    app.update_state(
-                        config,
-                        {"approved": True},
-                        as_node="human_review"
-                    )
-                else:
-                    # 拒否してフィードバック
-                    feedback = input("フィードバックを入力してください > ")
-                    app.update_state(
-                        config,
-                        {"approved": False, "feedback": feedback},
-                        as_node="human_review"
-                    )
-                
-                # 次のループで続行
-                current_state = None
+                # interrupt()の戻り値として渡して再開
+                # 中断中のhuman_reviewノードだけが再実行され、agentノード（Bedrock呼び出し）はやり直さない
+                current_state = Command(resume=approval_data)
                 continue
         
         # interruptがない場合は終了
@@ -504,6 +312,13 @@ if __name__ == "__main__":
     # 環境変数を読み込み
     load_dotenv()
     
+    # ログレベルはLOG_LEVELで指定（DEBUGでノードの入出力を表示）
+    # 小文字や不明なレベル名はWARNINGとして扱う（basicConfigのValueErrorを防ぐ）
+    log_level = os.getenv("LOG_LEVEL", "WARNING").upper()
+    if not isinstance(logging.getLevelName(log_level), int):
+        log_level = "WARNING"
+    logging.basicConfig(level=log_level)
+    
     if not os.getenv("AWS_BEDROCK_MODEL"):
         print("⚠️  AWS Bedrockの設定を確認してください。")
         print(".envファイルでAWS_BEDROCK_MODELを設定するか、")
@@ -514,4 +329,4 @@ if __name__ == "__main__":
         print("   - Web UI、API、Slackなどと統合可能")
         print("   - 状態が永続化され、後から再開可能")
     else:
-        main()
+        asyncio.run(main())
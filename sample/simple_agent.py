@@ -4,15 +4,19 @@
 より簡単に理解できるシンプルなバージョンです。
 """
 
+import asyncio
 import os
-from typing import Annotated, Sequence, TypedDict
-from pydantic import BaseModel, Field
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Annotated
+from pydantic import BaseModel, ConfigDict, Field
 
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
 from langchain_core.tools import tool
 from langchain_aws import ChatBedrock
 
 from langgraph.graph import StateGraph, END
+from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 
 
@@ -30,13 +34,37 @@ def multiply_numbers(a: float, b: float) -> float:
     return a * b
 
 
-tools = [add_numbers, multiply_numbers]
+# batch_toolから呼び出せるツール
+_tools_by_name = {t.name: t for t in [add_numbers, multiply_numbers]}
+
+
+async def _run_invocation(invocation: dict):
+    """batch_toolの1件分の呼び出しを実行"""
+    target = _tools_by_name.get(invocation.get("name"))
+    if target is None:
+        return f"エラー: 不明なツールです: {invocation.get('name')}"
+    return await target.ainvoke(invocation.get("arguments", {}))
+
+
+@tool
+async def batch_tool(invocations: list[dict]) -> list:
+    """複数のツールをまとめて並列に呼び出します。
+    invocationsの各要素は {"name": ツール名, "arguments": 引数の辞書} です"""
+    return await asyncio.gather(*[
+        _run_invocation(invocation) for invocation in invocations
+    ])
+
+
+tools = [add_numbers, multiply_numbers, batch_tool]
 
 
 # ========== 構造化された出力 ==========
 
 class CalculationResult(BaseModel):
     """計算結果の構造化された出力"""
+    # 生成後に変更しない読み取り専用の結果
+    model_config = ConfigDict(frozen=True)
+    
     question: str = Field(description="元の質問")
     steps: list[str] = Field(description="実行したステップ")
     final_result: str = Field(description="最終結果")
@@ -44,53 +72,83 @@ class CalculationResult(BaseModel):
 
 # ========== 状態 ==========
 
-class State(TypedDict):
-    messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]
-    approved: bool
+@dataclass(slots=True)
+class State:
+    # IDで既存メッセージを更新・追加する組み込みのreducer
+    messages: Annotated[list[BaseMessage], add_messages] = field(default_factory=list)
+    approved: bool = False
 
 
-# ========== ノード ==========
+# ========== LLM ==========
+# load_dotenv()は__main__で呼ばれるため、モデルIDはノード実行時に解決し
+# 生成したLLMはキャッシュして各ステップで使い回す
 
-def agent_node(state: State):
-    """エージェント: 次のアクションを決定"""
-    llm = ChatBedrock(
-        model_id=os.getenv("AWS_BEDROCK_MODEL", "anthropic.claude-3-5-sonnet-20241022-v2:0"),
+def _get_model_id() -> str:
+    """使用するBedrockのモデルIDを取得"""
+    return os.getenv("AWS_BEDROCK_MODEL", "anthropic.claude-3-5-sonnet-20241022-v2:0")
+
+
+@lru_cache(maxsize=2)
+def _get_chat_bedrock(model_id: str) -> ChatBedrock:
+    """ChatBedrockをモデルIDごとに一度だけ生成"""
+    return ChatBedrock(
+        model_id=model_id,
         model_kwargs={"temperature": 0}
     )
-    llm_with_tools = llm.bind_tools(tools)
-    response = llm_with_tools.invoke(state["messages"])
+
+
+@lru_cache(maxsize=2)
+def _get_llm(model_id: str):
+    """ツールをバインド済みのLLMを返す"""
+    return _get_chat_bedrock(model_id).bind_tools(tools)
+
+
+@lru_cache(maxsize=2)
+def _get_structured_llm(model_id: str):
+    """CalculationResultを出力するLLMを返す（ツール呼び出しを強制して解析）"""
+    return _get_chat_bedrock(model_id).with_structured_output(CalculationResult)
+
+
+# ========== ノード ==========
+
+# システムプロンプト（独立した複数の計算はbatch_toolで1回にまとめさせる）
+system_message = SystemMessage(
+    content="互いに依存しない複数のツール呼び出しが必要な場合は、"
+            "batch_toolを使って1回の呼び出しにまとめてください。"
+)
+
+
+async def agent_node(state: State):
+    """エージェント: 次のアクションを決定"""
+    llm_with_tools = _get_llm(_get_model_id())
+    response = await llm_with_tools.ainvoke((system_message, *state.messages))
     return {"messages": [response]}
 
 
 def human_approval_node(state: State):
     """人間の承認を求める"""
-    last_message = state["messages"][-1]
+    last_message = state.messages[-1]
     
     print("\n" + "="*50)
     print("🤔 承認が必要です")
     print("="*50)
     
-    if hasattr(last_message, "tool_calls"):
-        for tc in last_message.tool_calls:
-            print(f"ツール: {tc['name']}")
-            print(f"引数: {tc['args']}")
+    for tc in getattr(last_message, "tool_calls", None) or []:
+        print(f"ツール: {tc['name']}")
+        print(f"引数: {tc['args']}")
     
     approval = input("\n承認しますか？ (y/n) > ").strip().lower()
     
     return {"approved": approval in ["y", "yes"]}
 
 
-def finalize_node(state: State):
+async def finalize_node(state: State):
     """最終的な構造化出力を生成"""
-    llm = ChatBedrock(
-        model_id=os.getenv("AWS_BEDROCK_MODEL", "anthropic.claude-3-5-sonnet-20241022-v2:0"),
-        model_kwargs={"temperature": 0}
-    )
-    structured_llm = llm.with_structured_output(CalculationResult)
+    structured_llm = _get_structured_llm(_get_model_id())
     
-    result = structured_llm.invoke([
+    result = await structured_llm.ainvoke([
         HumanMessage(content="会話履歴から計算結果をまとめてください"),
-        *state["messages"]
+        *state.messages
     ])
     
     print("\n" + "="*50)
@@ -109,18 +167,16 @@ def finalize_node(state: State):
 
 def should_continue(state: State):
     """次のノードを決定"""
-    last_message = state["messages"][-1]
+    last_message = state.messages[-1]
     
     # ツール呼び出しがあるか確認
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        return "human_approval"
-    
-    return "finalize"
+    tool_calls = getattr(last_message, "tool_calls", None)
+    return "human_approval" if tool_calls else "finalize"
 
 
 def after_approval(state: State):
     """承認後のルーティング"""
-    if state.get("approved", False):
+    if state.approved:
         return "tools"
     else:
         return "agent"
@@ -167,7 +223,7 @@ def create_simple_graph():
 
 # ========== メイン ==========
 
-def main():
+async def main():
     print("シンプルな Human-in-the-Loop エージェント")
     print("="*50)
     
@@ -182,7 +238,7 @@ def main():
         "approved": False
     }
     
-    for output in app.stream(initial_state):
+    async for output in app.astream(initial_state):
         pass  # ノードが進むたびに処理
 
 
@@ -196,4 +252,4 @@ if __name__ == "__main__":
         print(".envファイルでAWS_BEDROCK_MODELを設定するか、")
         print("AWS CLIで認証情報を設定してください。")
     else:
-        main()
+        asyncio.run(main())
@@ -1,20 +1,49 @@
+import asyncio
+import logging
+import os
 import uuid
+from collections import deque
+from itertools import groupby
 import streamlit as st
 from langchain_core.messages import HumanMessage
 from langgraph.types import Command
 from langfuse import Langfuse
 
-# agents_graph.pyからエージェントをインポート
-from agents_graph import agent_graph
-
-# 環境変数のロード
+# 環境変数のロード（同じプロセスで読み込み済みの場合はスキップ）
 from dotenv import load_dotenv
-load_dotenv()
+if not os.getenv("_DOTENV_LOADED"):
+    load_dotenv(override=False)
+    os.environ["_DOTENV_LOADED"] = "1"
+
+# ログ出力（LOG_LEVEL=DEBUG でデバッグログを表示）
+# 小文字や不明なレベル名はWARNINGとして扱う（basicConfigのValueErrorを防ぐ）
+log_level = os.getenv("LOG_LEVEL", "WARNING").upper()
+if not isinstance(logging.getLevelName(log_level), int):
+    log_level = "WARNING"
+logging.basicConfig(level=log_level)
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_graph():
+    """コンパイル済みのエージェントグラフを取得（全セッションで1つを共有）"""
+    # agents_graph.pyからエージェントをインポート
+    from agents_graph import agent_graph
+    return agent_graph
+
+@st.cache_resource
+def get_tool_html_namespace():
+    """承認画面用HTMLのストア上のnamespaceを取得（get_graph()と同様に一度だけインポート）"""
+    from agents_graph import TOOL_HTML_NAMESPACE
+    return TOOL_HTML_NAMESPACE
+
+# セッションに保持するメッセージ数の上限と、画面に表示する件数
+MAX_MESSAGES = 200
+DISPLAY_MESSAGES = 50
 
 def init_session_state():
     """セッション状態を初期化する"""
     if 'messages' not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=MAX_MESSAGES)
     if 'waiting_for_approval' not in st.session_state:
         st.session_state.waiting_for_approval = False
     if 'final_result' not in st.session_state:
@@ -23,10 +52,17 @@ def init_session_state():
         st.session_state.thread_id = None
     if "trace_id" not in st.session_state:
         st.session_state.trace_id = None
+    if "langfuse_handler" not in st.session_state:
+        # LangfuseのCallbackHandlerはセッションごとに一度だけ生成して使い回す
+        # APIキーが未設定の場合はトレースしないため生成しない
+        st.session_state.langfuse_handler = None
+        if os.getenv("LANGFUSE_PUBLIC_KEY"):
+            from langfuse.langchain import CallbackHandler
+            st.session_state.langfuse_handler = CallbackHandler()
 
 def reset_session():
     """セッション状態をリセットする"""
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
     st.session_state.waiting_for_approval = False
     st.session_state.final_result = None
     st.session_state.thread_id = None
@@ -40,17 +76,17 @@ def run_agent(input_data):
     # trace_idがまだなければ、thread_idから生成
     if not st.session_state.trace_id:
         st.session_state.trace_id = Langfuse.create_trace_id(seed=st.session_state.thread_id)
-        print(f"[Streamlit] 新しいtrace_idを生成: {st.session_state.trace_id}")
+        logger.debug("[Streamlit] 新しいtrace_idを生成: %s", st.session_state.trace_id)
     
-    # LangfuseのCallbackHandlerを初期化（引数なし）
-    from langfuse.langchain import CallbackHandler
-    langfuse_handler = CallbackHandler()
+    # Langfuseが無効な場合はコールバックを登録しない
+    langfuse_handler = st.session_state.langfuse_handler
+    callbacks = [langfuse_handler] if langfuse_handler else []
     
     # LangGraphの設定
     # metadataでsession_id, user_id, tagsを設定してinterruptの前後をつなげる
     config = {
         "configurable": {"thread_id": st.session_state.thread_id},
-        "callbacks": [langfuse_handler],
+        "callbacks": callbacks,
         "metadata": {
             "langfuse_session_id": st.session_state.thread_id,  # interruptの前後で同じsession_id
             "langfuse_tags": ["graph-api", "with-interrupt"]
@@ -68,31 +104,47 @@ def run_agent(input_data):
             "trace_id": st.session_state.trace_id
         }
     
-    print(f"[Streamlit] trace_id: {st.session_state.trace_id}")
-    print(f"[Streamlit] session_id: {st.session_state.thread_id}")
+    logger.debug("[Streamlit] trace_id: %s", st.session_state.trace_id)
+    logger.debug("[Streamlit] session_id: %s", st.session_state.thread_id)
     
     # 結果を処理
     with st.spinner("処理中...", show_time=True):
-        for event in agent_graph.stream(stream_input, config=config, stream_mode="updates"):
-            for node_name, node_output in event.items():
-                print(f"[Streamlit] イベント受信: {node_name}")
-                
-                # interruptの場合
-                if node_name == "__interrupt__":
-                    st.session_state.tool_info = node_output[0].value
-                    st.session_state.waiting_for_approval = True
-                
-                # agentノードからの出力
-                elif node_name == "agent":
-                    # 最後のメッセージを取得
-                    if "messages" in node_output and node_output["messages"]:
-                        last_msg = node_output["messages"][-1]
-                        # ツール呼び出しがない場合は最終結果として扱う
-                        if hasattr(last_msg, 'content') and not getattr(last_msg, 'tool_calls', None):
-                            st.session_state.final_result = last_msg.content
-        
+        # LLMの出力をトークン単位で表示する領域
+        placeholder = st.empty()
+        asyncio.run(stream_agent(stream_input, config, placeholder))
         st.rerun()
 
+async def stream_agent(stream_input, config, placeholder):
+    """グラフを非同期ストリーム実行し、イベントをセッション状態に反映する"""
+    streamed_text = ""
+    # チェックポイントは各ステップで同期保存（非同期保存の滞留を防ぐ）
+    async for mode, event in get_graph().astream(stream_input, config=config, stream_mode=["updates", "custom"], durability="sync"):
+        # agentノードから通知されたトークンを逐次表示
+        if mode == "custom":
+            streamed_text += event
+            placeholder.markdown(streamed_text)
+            continue
+        
+        for node_name, node_output in event.items():
+            logger.debug("[Streamlit] イベント受信: %s", node_name)
+            
+            # interruptの場合
+            if node_name == "__interrupt__":
+                st.session_state.tool_info = node_output[0].value
+                st.session_state.waiting_for_approval = True
+            
+            # agentノードからの出力
+            elif node_name == "agent":
+                # 次のLLM呼び出しのトークンは新しく表示し直す
+                streamed_text = ""
+                # 追加されたメッセージのうち最後の1件のみを参照
+                agent_messages = node_output.get("messages")
+                last_msg = agent_messages[-1] if agent_messages else None
+                # ツール呼び出しがない場合は最終結果として扱う
+                if last_msg and not getattr(last_msg, 'tool_calls', None):
+                    # ストリーミングで結合したメッセージのcontentはブロックのリストのため、テキストのみ取り出す
+                    st.session_state.final_result = last_msg.text
+
 def feedback():
     """フィードバックを取得し、エージェントに通知する関数"""       
     approve_column, deny_column = st.columns(2)
@@ -109,31 +161,49 @@ def feedback():
                 
     return feedback_result
 
+@st.fragment
+def render_history():
+    """メッセージ履歴を表示する（fragmentとして部分的に再実行）"""
+    # 直近のメッセージのみ、同じroleが連続する部分は1つの吹き出しにまとめて表示
+    recent_messages = list(st.session_state.messages)[-DISPLAY_MESSAGES:]
+    for role, msgs in groupby(recent_messages, key=lambda msg: msg["role"]):
+        with st.chat_message("user" if role == "user" else "assistant"):
+            st.markdown("\n\n---\n\n".join(msg["content"] for msg in msgs))
+
+@st.fragment
+def render_approval():
+    """ツールの承認を求める（ボタン操作ではこのfragmentのみ再実行）"""
+    st.info(st.session_state.tool_info["args"])
+    if st.session_state.tool_info["name"] == "write_file":
+        with st.container(height=400):
+            # HTML本文はグラフのストアから参照キーで取得
+            html_item = get_graph().store.get(
+                get_tool_html_namespace(), st.session_state.tool_info["html_ref"]
+            )
+            # 承認処理後に削除済み、またはセッションをまたいで古い情報が残っている場合
+            if html_item is None:
+                st.info("保存内容のプレビューを表示できません。")
+            else:
+                st.html(html_item.value["html"], width="stretch")
+    feedback_result = feedback()
+    if feedback_result:
+        st.chat_message("user").write(feedback_result)
+        st.session_state.messages.append({"role": "user", "content": feedback_result})
+        # interruptの再開コマンドを送信（完了後はアプリ全体を再実行）
+        run_agent(Command(resume=feedback_result))
+        st.rerun()
+
 def app():
     # タイトルの設定
     st.title("Webリサーチエージェント (Graph API版)")
 
     # メッセージ表示エリア
-    for msg in st.session_state.messages:
-        if msg["role"] == "user":
-            st.chat_message("user").write(msg["content"])
-        else:
-            st.chat_message("assistant").write(msg["content"])
+    render_history()
             
     # ツール承認の確認
     if st.session_state.waiting_for_approval \
        and st.session_state.tool_info:
-        st.info(st.session_state.tool_info["args"])
-        if st.session_state.tool_info["name"] == "write_file":
-            with st.container(height=400):
-                st.html(st.session_state.tool_info["html"], width="stretch")
-        feedback_result = feedback()
-        if feedback_result:
-            st.chat_message("user").write(feedback_result)
-            st.session_state.messages.append({"role": "user", "content": feedback_result})
-            # interruptの再開コマンドを送信
-            run_agent(Command(resume=feedback_result))
-            st.rerun()
+        render_approval()
 
     # 最終結果の表示
     if st.session_state.final_result \
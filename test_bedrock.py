@@ -5,11 +5,29 @@ AWS Bedrock接続テスト
 """
 
 import os
+from functools import lru_cache
+
+import boto3
+from botocore.config import Config
 from dotenv import load_dotenv
 from langchain_aws import ChatBedrock
 
 load_dotenv()
 
+# 接続プールとTCP keep-aliveで、2回目以降の呼び出しはコネクションを再利用する
+bedrock_config = Config(
+    retries={"max_attempts": 2, "mode": "adaptive"},
+    max_pool_connections=32,
+    tcp_keepalive=True,
+)
+
+
+@lru_cache(maxsize=4)
+def get_bedrock_client(region: str):
+    """bedrock-runtimeクライアントをリージョンごとに一度だけ生成して再利用"""
+    return boto3.client("bedrock-runtime", region_name=region, config=bedrock_config)
+
+
 def test_bedrock_connection():
     """AWS Bedrock接続をテスト"""
     print("AWS Bedrock接続テスト")
@@ -26,24 +44,25 @@ def test_bedrock_connection():
     try:
         # ChatBedrockインスタンスを作成
         llm = ChatBedrock(
+            client=get_bedrock_client(region),
             model_id=model_id,
-            region_name=region,
             model_kwargs={
                 "temperature": 0,
                 "max_tokens": 100
             }
         )
         
-        # 簡単なテストメッセージ
+        # 簡単なテストメッセージ（生成されたトークンから順に表示）
         print("テストメッセージを送信中...")
-        response = llm.invoke("こんにちは！簡単な自己紹介をしてください。")
-        
-        print("\n✅ 接続成功！")
         print("\nレスポンス:")
         print("-"*50)
-        print(response.content)
+        for chunk in llm.stream("こんにちは！簡単な自己紹介をしてください。"):
+            print(chunk.text, end="", flush=True)
+        print()
         print("-"*50)
         
+        print("\n✅ 接続成功！")
+        
         return True
         
     except Exception as e: